@@ -1,23 +1,40 @@
 # chatbot_service.py - Standalone FastAPI Chatbot Service
 
-import pandas as pd
 import faiss
+import torch
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import sys
 import re
 import os
-from typing import List, Optional, Dict, Any
-from beanie import Document, init_beanie
+import json
+import hashlib
+import functools
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Dict, Any, Union
+from beanie import Document, UpdateResponse, init_beanie
 import motor.motor_asyncio
 from pydantic import BaseModel, Field, ConfigDict
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import asyncio
+import threading
+import contextlib
 import uvicorn
 import pymongo
+from cachetools import TTLCache
+
+try:
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
 
 # --- Load environment variables ---
 load_dotenv()
@@ -30,16 +47,67 @@ MONGO_DATABASE_NAME = os.getenv("MONGO_DATABASE_NAME", "test")  # Default databa
 # --- Model Settings ---
 GEMINI_MODEL_NAME = "models/gemini-1.5-flash-latest"
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+ONNX_EMBEDDING_MODEL_ID = 'sentence-transformers/all-MiniLM-L6-v2'
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models/all-MiniLM-L6-v2-int8")
+USE_ONNX_EMBEDDER = os.getenv("USE_ONNX_EMBEDDER", "true").lower() == "true"
+EMBEDDING_MAX_SEQ_LENGTH = 256
+# Half precision for the SentenceTransformer fallback: FP16 on CUDA, BF16 on CPU only when opted in
+# (BF16 is only fast on CPUs with native support, e.g. AVX512-BF16/AMX).
+EMBEDDER_CPU_BF16 = os.getenv("EMBEDDER_CPU_BF16", "false").lower() == "true"
 FAISS_THRESHOLD = 0.7
 TRACK_NAME_MATCH_THRESHOLD = 0.85
+KEYWORD_TOP_K = 3
+# Optional PCA projection of the track embeddings (0 disables). Projected cosines are
+# distributed differently, so re-check FAISS_THRESHOLD/TRACK_NAME_MATCH_THRESHOLD when enabling.
+EMBEDDING_PCA_COMPONENTS = int(os.getenv("EMBEDDING_PCA_COMPONENTS", "0"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "cache")
+EMBEDDING_DIM = 384  # Output size of all-MiniLM-L6-v2
+RESPONSE_CACHE_THRESHOLD = 0.95
+RESPONSE_CACHE_TOP_K = 5
+RESPONSE_CACHE_CONTEXT_MESSAGES = 4  # Trailing messages that must match for a cached reply to be reused
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 100_000
+
+# --- Encoder Batching Settings ---
+ENCODER_BATCH_MAX_SIZE = 32
+ENCODER_BATCH_WINDOW_SECONDS = 0.005
+
+# --- Thread Settings ---
+# sched_getaffinity honours container CPU limits, unlike os.cpu_count().
+_AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 4)
+NUM_THREADS = int(os.getenv("CHATBOT_NUM_THREADS", _AVAILABLE_CPUS))
+
+# --- Chat History Settings ---
+CONVERSATION_HISTORY_WINDOW = 10  # Messages included in the prompt
+MAX_STORED_MESSAGES = 20  # Stored history is capped so session documents stay constant-size
+
+# --- Session Cache Settings ---
+SESSION_CACHE_MAXSIZE = 10_000
+SESSION_CACHE_TTL_SECONDS = 300
 
 # --- Global variables to be populated at startup ---
-df_tracks: Optional[pd.DataFrame] = None
 official_track_names: List[str] = []
-keyword_index: Optional[faiss.Index] = None
-track_name_index: Optional[faiss.Index] = None
-embedder_instance: Optional[SentenceTransformer] = None
+corpus_hash: str = ""  # Identifies the loaded roadmap corpus; cached replies are tied to it
+# Corpus embeddings are tiny (one row per track text), so they are kept as dense matrices
+# and searched with a single matrix-vector product instead of a FAISS index.
+keyword_matrix: Optional[np.ndarray] = None
+keyword_track_ids: Optional[np.ndarray] = None  # row -> index into official_track_names
+track_name_matrix: Optional[np.ndarray] = None
+track_name_track_ids: Optional[np.ndarray] = None
+pca_mean: Optional[np.ndarray] = None
+pca_components: Optional[np.ndarray] = None  # (n_components, EMBEDDING_DIM)
+embedder_instance: Optional[Union[SentenceTransformer, "OnnxSentenceEncoder"]] = None
 gemini_model: Optional[genai.GenerativeModel] = None
+response_cache_index: Optional[faiss.Index] = None
+gpu_resources: Optional["faiss.StandardGpuResources"] = None  # Shared by all GPU indexes
+response_cache_responses: List[str] = []
+response_cache_context_hashes: List[str] = []
+response_cache_expires_at: List[float] = []
+# Cache searches run in worker threads; FAISS does not allow concurrent search and add.
+response_cache_lock = threading.Lock()
+# Hot sessions kept in-process so follow-up turns skip the Mongo read. This service is
+# the only writer of chat_sessions, so entries stay valid while a single worker runs.
+SESSION_CACHE: "TTLCache[str, ChatSession]" = TTLCache(maxsize=SESSION_CACHE_MAXSIZE, ttl=SESSION_CACHE_TTL_SECONDS)
 
 # --- MongoDB Models ---
 class Roadmap(Document):
@@ -50,6 +118,12 @@ class Roadmap(Document):
     class Settings:
         name = "roadmaps"
 
+class RoadmapLite(BaseModel):
+    """Projection of the Roadmap fields the chatbot indexes."""
+    title: str
+    requirments: Optional[str] = None
+    target_audience: Optional[str] = None
+
 class ChatMessage(BaseModel):
     role: str
     content: str
@@ -64,6 +138,21 @@ class ChatSession(Document):
 
     class Settings:
         name = "chat_sessions"
+        indexes = [pymongo.IndexModel("session_id", unique=True)]
+
+class ResponseCacheEntry(Document):
+    embedding: bytes  # float32 query embedding
+    response: str
+    context_hash: str
+    corpus_hash: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "response_cache"
+        indexes = [
+            pymongo.IndexModel("created_at", expireAfterSeconds=RESPONSE_CACHE_TTL_SECONDS),
+            pymongo.IndexModel("corpus_hash")
+        ]
 
 # --- API Request/Response Models ---
 class ChatRequest(BaseModel):
@@ -74,125 +163,405 @@ class ChatResponse(BaseModel):
     assistant_message: str
     session_id: str
 
+# --- Embedding Backends ---
+class OnnxSentenceEncoder:
+    """INT8-quantized ONNX Runtime drop-in for SentenceTransformer.encode (mean pooling)."""
+
+    QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+    def __init__(self, model_id: str, model_dir: str):
+        if not os.path.exists(os.path.join(model_dir, self.QUANTIZED_FILE_NAME)):
+            print(f"Exporting '{model_id}' to ONNX with dynamic INT8 quantization...")
+            fp32_model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+            quantizer = ORTQuantizer.from_pretrained(fp32_model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+            quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = NUM_THREADS
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=self.QUANTIZED_FILE_NAME,
+            provider="CPUExecutionProvider",
+            session_options=sess_options
+        )
+
+    def encode(self, texts: List[str], normalize_embeddings: bool = True, convert_to_numpy: bool = True,
+               batch_size: int = 32) -> np.ndarray:
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=EMBEDDING_MAX_SEQ_LENGTH,
+                return_tensors="np"
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].astype(np.float32)
+            # Masked token sum as a batched matmul, without a (batch, tokens, dim) temporary.
+            summed = np.matmul(mask[:, None, :], token_embeddings)[:, 0, :]
+            batches.append(summed / np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None))
+        if not batches:
+            return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        # Per-request calls produce a single batch; only concatenate (and copy) when needed.
+        embeddings = batches[0] if len(batches) == 1 else np.concatenate(batches)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+def load_embedder() -> Union[SentenceTransformer, OnnxSentenceEncoder]:
+    if USE_ONNX_EMBEDDER and ORTModelForFeatureExtraction is not None:
+        try:
+            encoder = OnnxSentenceEncoder(ONNX_EMBEDDING_MODEL_ID, ONNX_MODEL_DIR)
+            print("Using INT8 ONNX Runtime embedder.")
+            return encoder
+        except Exception as e:
+            print(f"ONNX embedder unavailable, falling back to SentenceTransformer: {e}", file=sys.stderr)
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    if torch.cuda.is_available():
+        model = model.half()
+        print("Using FP16 SentenceTransformer embedder.")
+    elif EMBEDDER_CPU_BF16:
+        model = model.to(torch.bfloat16)
+        print("Using BF16 SentenceTransformer embedder.")
+    return model
+
 # --- Helper Functions ---
+def encode_texts(texts: List[str]) -> np.ndarray:
+    embeddings = embedder_instance.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+    # Half-precision models return float16; searches and the response cache expect float32.
+    return np.asarray(embeddings, dtype=np.float32)
+
+class EncoderBatcher:
+    """Coalesces concurrent single-text encode requests into one batched encoder call."""
+
+    def __init__(self, max_batch_size: int, window_seconds: float):
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+            self._queue = None
+
+    async def encode(self, text: str) -> np.ndarray:
+        """Returns a (1, dim) float32 array, same as encode_texts([text])."""
+        if self._queue is None:
+            return await asyncio.to_thread(encode_texts, [text])
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Give concurrent handlers a short window to join this batch.
+            await asyncio.sleep(self.window_seconds)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                embeddings = await asyncio.to_thread(encode_texts, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for row, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(embeddings[row:row + 1])
+
+encoder_batcher = EncoderBatcher(ENCODER_BATCH_MAX_SIZE, ENCODER_BATCH_WINDOW_SECONDS)
+
+def embedder_cache_key() -> str:
+    if isinstance(embedder_instance, OnnxSentenceEncoder):
+        return f"onnx-int8:{ONNX_EMBEDDING_MODEL_ID}"
+    return f"sentence-transformers:{EMBEDDING_MODEL_NAME}:{next(embedder_instance.parameters()).dtype}"
+
+def corpus_cache_path(texts: List[str]) -> str:
+    # Keyed by encoder and exact corpus contents, so any roadmap edit produces a new file.
+    digest = hashlib.sha256(json.dumps([embedder_cache_key(), texts]).encode("utf-8")).hexdigest()
+    return os.path.join(EMBEDDING_CACHE_DIR, f"corpus_emb_{digest}.npy")
+
+def load_or_encode_corpus(texts: List[str]) -> np.ndarray:
+    cache_path = corpus_cache_path(texts)
+    if os.path.exists(cache_path):
+        try:
+            embeddings = np.load(cache_path, mmap_mode="r")
+            if embeddings.shape[0] == len(texts):
+                print(f"Loaded cached corpus embeddings from '{cache_path}'.")
+                return embeddings
+        except Exception as e:
+            print(f"Error reading embedding cache '{cache_path}', re-encoding: {e}", file=sys.stderr)
+    embeddings = encode_texts(texts)
+    try:
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, embeddings)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write embedding cache '{cache_path}': {e}", file=sys.stderr)
+    return embeddings
+
+def fit_pca(embeddings: np.ndarray, n_components: int):
+    mean = embeddings.mean(axis=0)
+    # Rows of vt are the principal axes, ordered by explained variance.
+    _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return mean.astype(np.float32), np.ascontiguousarray(vt[:n_components], dtype=np.float32)
+
+def project_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    if pca_components is None:
+        return embeddings
+    projected = (embeddings - pca_mean) @ pca_components.T
+    projected /= np.clip(np.linalg.norm(projected, axis=1, keepdims=True), 1e-12, None)
+    return projected
+
 async def load_roadmap_data_from_mongodb():
-    global df_tracks, official_track_names, keyword_index, track_name_index, embedder_instance
+    global official_track_names, keyword_matrix, keyword_track_ids, track_name_matrix, track_name_track_ids
+    global pca_mean, pca_components, corpus_hash
     try:
         print("Loading roadmap data from MongoDB...")
-        roadmaps = await Roadmap.find_all().to_list()
-        if not roadmaps:
+        # Parallel per-field lists; index i describes the same track in each.
+        track_names: List[str] = []
+        keywords_list: List[str] = []
+        matching_interests: List[str] = []
+        async for roadmap in Roadmap.find_all(projection_model=RoadmapLite):
+            track_names.append(roadmap.title)
+            keywords_list.append(roadmap.requirments or "")
+            matching_interests.append(roadmap.target_audience or "")
+        official_track_names = track_names
+        corpus_hash = hashlib.sha256(
+            json.dumps([track_names, keywords_list, matching_interests]).encode("utf-8")
+        ).hexdigest()
+        if not official_track_names:
             print("Warning: No roadmap data found in MongoDB")
-            df_tracks = pd.DataFrame(columns=["track", "keywords", "matching interests"])
-            official_track_names = []
             return
 
-        roadmap_data = []
-        for roadmap in roadmaps:
-            track_name = roadmap.title
-            keywords = roadmap.requirments if roadmap.requirments else ""
-            interests = roadmap.target_audience if roadmap.target_audience else ""
-            roadmap_data.append([track_name, keywords, interests])
-
-        df_tracks = pd.DataFrame(roadmap_data, columns=["track", "keywords", "matching interests"])
-        official_track_names = df_tracks["track"].astype(str).tolist()
-        keywords_list = df_tracks["keywords"].astype(str).tolist()
-        matching_interests = df_tracks["matching interests"].astype(str).tolist()
-
         print(f"Found {len(official_track_names)} tracks from MongoDB.")
 
+        track_count = len(official_track_names)
         all_texts_to_embed = keywords_list + matching_interests
-        if any(t for t in all_texts_to_embed if t):
-            print("Generating embeddings for keyword/interest FAISS index...")
-            valid_texts = [t for t in all_texts_to_embed if t]
-            if valid_texts:
-                keyword_embeddings = embedder_instance.encode(valid_texts, normalize_embeddings=True)
-                if keyword_embeddings.size > 0:
-                    keyword_index = faiss.IndexFlatIP(keyword_embeddings.shape[1])
-                    keyword_index.add(np.array(keyword_embeddings).astype("float32"))
-                    print("Keyword/Interest FAISS index built successfully.")
-
-        print("Generating embeddings for track name FAISS index...")
-        valid_track_names = [t for t in official_track_names if t]
-        if valid_track_names:
-            track_name_embeddings = embedder_instance.encode(valid_track_names, normalize_embeddings=True)
-            if track_name_embeddings.size > 0:
-                track_name_index = faiss.IndexFlatIP(track_name_embeddings.shape[1])
-                track_name_index.add(np.array(track_name_embeddings).astype("float32"))
-                print("Track name FAISS index built successfully.")
+        keyword_rows = [(i % track_count, t) for i, t in enumerate(all_texts_to_embed) if t]
+        track_name_rows = [(i, t) for i, t in enumerate(official_track_names) if t]
+        texts_to_encode = [t for _, t in keyword_rows] + [t for _, t in track_name_rows]
+
+        # Encode keywords/interests and track names in a single batched call.
+        print("Generating embeddings for keyword/interest and track name matrices...")
+        all_embeddings = load_or_encode_corpus(texts_to_encode) if texts_to_encode else None
+        if all_embeddings is not None and EMBEDDING_PCA_COMPONENTS > 0:
+            pca_mean, pca_components = fit_pca(all_embeddings, EMBEDDING_PCA_COMPONENTS)
+            all_embeddings = project_embeddings(all_embeddings)
+            print(f"Projected track embeddings to {pca_components.shape[0]} dimensions with PCA.")
+        if keyword_rows:
+            keyword_matrix = np.ascontiguousarray(all_embeddings[:len(keyword_rows)], dtype=np.float32)
+            keyword_track_ids = np.array([track_idx for track_idx, _ in keyword_rows])
+            print("Keyword/Interest embedding matrix built successfully.")
+
+        if track_name_rows:
+            track_name_matrix = np.ascontiguousarray(all_embeddings[len(keyword_rows):], dtype=np.float32)
+            track_name_track_ids = np.array([track_idx for track_idx, _ in track_name_rows])
+            print("Track name embedding matrix built successfully.")
 
     except Exception as e:
         print(f"Error loading roadmap data: {e}", file=sys.stderr)
         raise
 
-def get_relevant_tracks_from_keywords(user_message: str) -> List[str]:
-    if keyword_index is None or embedder_instance is None or not official_track_names:
+def create_response_cache_index() -> faiss.Index:
+    global gpu_resources
+    # CPU-only FAISS builds do not ship the GPU classes.
+    if hasattr(faiss, "StandardGpuResources"):
+        try:
+            if faiss.get_num_gpus() > 0:
+                if gpu_resources is None:
+                    gpu_resources = faiss.StandardGpuResources()
+                index = faiss.GpuIndexFlatIP(gpu_resources, EMBEDDING_DIM)
+                print("Using GPU FAISS index for the response cache.")
+                return index
+        except Exception as e:
+            # The cache is an optimization only; a broken GPU setup must not block startup.
+            print(f"GPU FAISS unavailable, using CPU index for the response cache: {e}", file=sys.stderr)
+    return faiss.IndexFlatIP(EMBEDDING_DIM)
+
+async def load_response_cache_from_mongodb():
+    global response_cache_index, response_cache_responses, response_cache_context_hashes, response_cache_expires_at
+    response_cache_index = create_response_cache_index()
+    response_cache_responses = []
+    response_cache_context_hashes = []
+    response_cache_expires_at = []
+    try:
+        print("Loading semantic response cache from MongoDB...")
+        # Replies generated against another roadmap corpus may name deleted or renamed tracks.
+        await ResponseCacheEntry.find({"corpus_hash": {"$ne": corpus_hash}}).delete()
+        entries = await ResponseCacheEntry.find(ResponseCacheEntry.corpus_hash == corpus_hash) \
+            .sort(-ResponseCacheEntry.created_at).limit(RESPONSE_CACHE_MAX_ENTRIES).to_list()
+        if entries:
+            embeddings = np.vstack([np.frombuffer(entry.embedding, dtype=np.float32) for entry in entries])
+            response_cache_index.add(embeddings)
+            response_cache_responses = [entry.response for entry in entries]
+            response_cache_context_hashes = [entry.context_hash for entry in entries]
+            # Mongo returns naive UTC datetimes.
+            response_cache_expires_at = [
+                entry.created_at.replace(tzinfo=timezone.utc).timestamp() + RESPONSE_CACHE_TTL_SECONDS
+                for entry in entries
+            ]
+        print(f"Loaded {len(response_cache_responses)} cached responses.")
+    except Exception as e:
+        # The cache is an optimization only; start empty rather than failing startup.
+        response_cache_index.reset()
+        response_cache_responses = []
+        response_cache_context_hashes = []
+        response_cache_expires_at = []
+        print(f"Error loading response cache, starting with an empty cache: {e}", file=sys.stderr)
+
+def compute_context_hash(rejected_roadmaps: List[str], last_suggested_roadmap: Optional[str],
+                         recent_messages: List[ChatMessage]) -> str:
+    # A reply is only reusable after the same preceding exchange, not just the same session state.
+    history = [[msg.role, msg.content] for msg in recent_messages[-RESPONSE_CACHE_CONTEXT_MESSAGES:]]
+    payload = json.dumps([sorted(rejected_roadmaps), last_suggested_roadmap, history])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def find_cached_response(query_vec: np.ndarray, context_hash: str) -> Optional[str]:
+    if response_cache_index is None or response_cache_index.ntotal == 0:
+        return None
+    try:
+        now = time.time()
+        with response_cache_lock:
+            D, I = response_cache_index.search(query_vec, k=min(RESPONSE_CACHE_TOP_K, response_cache_index.ntotal))
+            for score, index_hit in zip(D[0], I[0]):
+                if index_hit < 0 or score < RESPONSE_CACHE_THRESHOLD:
+                    break
+                # Only reuse an unexpired response produced under the same conversation context.
+                if response_cache_context_hashes[index_hit] == context_hash and response_cache_expires_at[index_hit] > now:
+                    return response_cache_responses[index_hit]
+        return None
+    except Exception as e:
+        print(f"Error during response cache search: {e}", file=sys.stderr)
+        return None
+
+def add_to_response_cache(query_vec: np.ndarray, response_text: str, context_hash: str) -> bool:
+    with response_cache_lock:
+        # Flat indexes cannot evict; once full, new replies wait for the next restart to be cached,
+        # which reloads only the newest unexpired entries.
+        if response_cache_index.ntotal >= RESPONSE_CACHE_MAX_ENTRIES:
+            return False
+        response_cache_index.add(query_vec)
+        response_cache_responses.append(response_text)
+        response_cache_context_hashes.append(context_hash)
+        response_cache_expires_at.append(time.time() + RESPONSE_CACHE_TTL_SECONDS)
+        return True
+
+async def store_cached_response(query_vec: np.ndarray, response_text: str, context_hash: str):
+    if response_cache_index is None:
+        return
+    try:
+        if not await asyncio.to_thread(add_to_response_cache, query_vec, response_text, context_hash):
+            return
+        await ResponseCacheEntry(
+            embedding=query_vec[0].tobytes(),
+            response=response_text,
+            context_hash=context_hash,
+            corpus_hash=corpus_hash
+        ).insert()
+    except Exception as e:
+        print(f"Error storing response in cache: {e}", file=sys.stderr)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # argpartition requires kth < len(scores); small corpora just return every row.
+    if k >= scores.shape[0]:
+        return np.arange(scores.shape[0])
+    return np.argpartition(-scores, k)[:k]
+
+def get_relevant_tracks_from_keywords(query_vec: np.ndarray) -> List[str]:
+    if keyword_matrix is None or not official_track_names:
         return []
     try:
-        query_vec = embedder_instance.encode([user_message], normalize_embeddings=True)
-        D, I = keyword_index.search(np.array(query_vec).astype("float32"), k=min(3, keyword_index.ntotal))
-        results = []
-        if I.ndim == 2 and I.size > 0:
-            for i in range(I.shape[1]):
-                score = D[0, i]
-                index_hit = I[0, i]
-                if score >= FAISS_THRESHOLD and index_hit >= 0:
-                    track_idx = index_hit % len(official_track_names)
-                    if 0 <= track_idx < len(official_track_names):
-                        results.append(official_track_names[track_idx])
-        return list(set(results))
+        scores = keyword_matrix @ project_embeddings(query_vec)[0]
+        results = set()
+        for row in top_k_indices(scores, KEYWORD_TOP_K):
+            if scores[row] >= FAISS_THRESHOLD:
+                results.add(official_track_names[keyword_track_ids[row]])
+        return list(results)
     except Exception as e:
-        print(f"Error during keyword FAISS search: {e}", file=sys.stderr)
+        print(f"Error during keyword similarity search: {e}", file=sys.stderr)
         return []
 
-def find_closest_official_track(suggested_track_name: str, threshold: float) -> Optional[str]:
-    if track_name_index is None or embedder_instance is None or not suggested_track_name or not official_track_names:
+def find_closest_official_track(query_vec: np.ndarray, threshold: float) -> Optional[str]:
+    if track_name_matrix is None or not official_track_names:
         return None
     try:
-        query_vec = embedder_instance.encode([suggested_track_name], normalize_embeddings=True)
-        query_vec_float32 = np.array(query_vec).astype("float32")
-        D, I = track_name_index.search(query_vec_float32, k=1)
-        if I.ndim == 2 and I.size > 0 and D.ndim == 2 and D.size > 0:
-            matched_index = I[0, 0]
-            score = D[0, 0]
-            if matched_index >= 0 and score >= threshold:
-                if 0 <= matched_index < len(official_track_names):
-                    return official_track_names[matched_index]
+        scores = track_name_matrix @ project_embeddings(query_vec)[0]
+        best_row = int(np.argmax(scores))
+        if scores[best_row] >= threshold:
+            return official_track_names[track_name_track_ids[best_row]]
         return None
     except Exception as e:
-        print(f"Error during track name FAISS search for '{suggested_track_name}': {e}", file=sys.stderr)
+        print(f"Error during track name similarity search: {e}", file=sys.stderr)
         return None
 
+SUGGESTED_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+RECOMMEND_RE = re.compile(r'recommend the\s+(.*?)\s+track', re.IGNORECASE)
+_STRIP_CHARS = " .:,!?"
+
 def extract_suggested_track(assistant_message: str) -> Optional[str]:
-    match = re.search(r'\*\*(.*?)\*\*', assistant_message)
+    match = SUGGESTED_BOLD_RE.search(assistant_message)
     if match:
-        track_name = match.group(1).strip(" .:,!?")
-        if len(track_name) > 3 and "track" not in track_name.lower() and "path" not in track_name.lower():
+        track_name = match.group(1).strip(_STRIP_CHARS)
+        track_name_lower = track_name.lower()
+        if len(track_name) > 3 and "track" not in track_name_lower and "path" not in track_name_lower:
             return track_name
-    match = re.search(r'recommend the\s+(.*?)\s+track', assistant_message, re.IGNORECASE)
+    match = RECOMMEND_RE.search(assistant_message)
     if match:
-        return match.group(1).strip(" .:,!?")
+        return match.group(1).strip(_STRIP_CHARS)
     return None
 
-def is_off_topic(user_input: str) -> bool:
-    off_topic_keywords = [
-        "كلمه عبيطه"
-    ]
-    learning_keywords = [
-        "learn", "teach", "course", "track", "skill", "programming", "develop", "code",
-        "study", "career", "tech", "data", "web", "mobile", "AI", "cloud", "security",
-        "frontend", "backend", "fullstack", "devops", "cybersecurity", "blockchain",
-        "game dev", "embedded", "iot", "ui/ux", "qa", "testing", "engineer", "analyst",
-        "scientist", "developer", "path", "roadmap", "guide", "advice", "recommend",
-        "tutorial", "lesson", "education", "training", "certification"
+OFF_TOPIC_KEYWORDS = [
+    "كلمه عبيطه"
+]
+LEARNING_KEYWORDS = [
+    "learn", "teach", "course", "track", "skill", "programming", "develop", "code",
+    "study", "career", "tech", "data", "web", "mobile", "AI", "cloud", "security",
+    "frontend", "backend", "fullstack", "devops", "cybersecurity", "blockchain",
+    "game dev", "embedded", "iot", "ui/ux", "qa", "testing", "engineer", "analyst",
+    "scientist", "developer", "path", "roadmap", "guide", "advice", "recommend",
+    "tutorial", "lesson", "education", "training", "certification"
+]
+REJECTION_KEYWORDS = ["no", "not interested", "don't like", "something else", "different"]
+ACCEPTANCE_KEYWORDS = ["yes", "interested", "sounds good", "tell me more", "like it"]
+
+# Short acronyms that would otherwise match inside everyday words ("ai" in "said", "again").
+WHOLE_WORD_KEYWORDS = frozenset({"AI"})
+
+def compile_keyword_pattern(keywords: List[str], whole_words: frozenset = frozenset()) -> re.Pattern:
+    # Plain substring alternation (same semantics as `keyword in text`), case-insensitive;
+    # keywords in `whole_words` only match as standalone words.
+    # This is a single C-level scan per check; a JIT byte scanner (e.g. Numba) only pays for
+    # its dependency and compile time once these lists grow to hundreds of terms.
+    alternatives = [
+        rf"\b{re.escape(keyword)}\b" if keyword in whole_words else re.escape(keyword)
+        for keyword in keywords
     ]
-    user_input_lower = user_input.lower()
-    has_learning_keyword = any(keyword in user_input_lower for keyword in learning_keywords)
-    has_off_topic_keyword = any(keyword in user_input_lower for keyword in off_topic_keywords)
-    if has_learning_keyword:
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+OFF_TOPIC_RE = compile_keyword_pattern(OFF_TOPIC_KEYWORDS)
+LEARNING_RE = compile_keyword_pattern(LEARNING_KEYWORDS, WHOLE_WORD_KEYWORDS)
+REJECTION_RE = compile_keyword_pattern(REJECTION_KEYWORDS)
+ACCEPTANCE_RE = compile_keyword_pattern(ACCEPTANCE_KEYWORDS)
+
+def is_off_topic(user_input: str) -> bool:
+    if LEARNING_RE.search(user_input):
         return False
-    if has_off_topic_keyword and not has_learning_keyword:
-        return True
-    return False
+    return OFF_TOPIC_RE.search(user_input) is not None
 
 # --- System Prompt Template ---
 SYSTEM_PROMPT_TEMPLATE = """
@@ -251,6 +620,32 @@ You are a professional and emotionally intelligent AI assistant guiding users to
 Remember, your goal is to make the user feel understood and guide them to a track they'll be excited about, even if they initially have no idea what they want to learn.
 """
 
+# Profile fields are not collected yet, so only the rejected tracks vary between requests.
+SYSTEM_PROMPT_PREFIX = SYSTEM_PROMPT_TEMPLATE.format(
+    experience_level="Not specified",
+    technical_interests="Not specified",
+    personal_goals="Not specified",
+    rejected_tracks="{rejected_tracks}"
+)
+
+@functools.lru_cache(maxsize=1024)
+def render_system_prompt(rejected_tracks_key: str) -> str:
+    return SYSTEM_PROMPT_PREFIX.format(rejected_tracks=rejected_tracks_key)
+
+def build_context(rejected_key: str, relevant_tracks: List[str]) -> str:
+    return f"""
+        Experience Level: Not specified
+        Technical Interests: Not specified
+        Personal Goals: Not specified
+        Rejected Roadmaps: {rejected_key}
+        Relevant Tracks Found: {', '.join(relevant_tracks) if relevant_tracks else 'None'}
+        """
+
+# A brand-new session has no history, rejections or pending suggestion, so everything up to
+# the per-request context is known at import time.
+FIRST_TURN_PROMPT_PREFIX = f"{render_system_prompt('None')}\n\nContext: "
+FIRST_TURN_CONTEXT_HASH = compute_context_hash([], None, [])
+
 
 # --- FastAPI App ---
 app = FastAPI(title="Chatbot Service", version="1.0.0")
@@ -264,20 +659,33 @@ app.add_middleware(
 )
 
 # --- Initialization ---
+def configure_thread_pools():
+    # Container defaults often leave Torch/OpenMP at a single thread. OMP_NUM_THREADS is read when
+    # torch/faiss load, so it is too late to set here; the runtime setters below apply instead.
+    torch.set_num_threads(NUM_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Can only be set before inter-op parallel work has started
+    faiss.omp_set_num_threads(NUM_THREADS)
+    print(f"Using {NUM_THREADS} threads for Torch, ONNX Runtime and FAISS.")
+
 async def initialize_chatbot_dependencies():
     global embedder_instance, gemini_model
     print("Initializing chatbot dependencies...")
     try:
+        configure_thread_pools()
         if not DATABASE_URI or not GEMINI_API_KEY:
             raise ValueError("DATABASE_URI and GEMINI_API_KEY must be set in .env file")
         client = motor.motor_asyncio.AsyncIOMotorClient(DATABASE_URI)
         db = client[MONGO_DATABASE_NAME]
-        await init_beanie(database=db, document_models=[ChatSession, Roadmap])
+        await init_beanie(database=db, document_models=[ChatSession, Roadmap, ResponseCacheEntry])
         print(f"Chatbot connected to MongoDB database '{MONGO_DATABASE_NAME}'.")
         genai.configure(api_key=GEMINI_API_KEY)
         gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-        embedder_instance = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        embedder_instance = load_embedder()
         await load_roadmap_data_from_mongodb()
+        await load_response_cache_from_mongodb()
         print("Chatbot dependencies initialized successfully.")
     except Exception as e:
         print(f"CRITICAL ERROR during chatbot initialization: {e}", file=sys.stderr)
@@ -286,64 +694,214 @@ async def initialize_chatbot_dependencies():
 @app.on_event("startup")
 async def startup_event():
     await initialize_chatbot_dependencies()
+    encoder_batcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await encoder_batcher.stop()
+
+# --- Chat Turn Helpers ---
+OFF_TOPIC_RESPONSE = "I'm here to help you choose the best learning track. Unfortunately, I can't assist with this topic."
+
+async def load_chat_session(session_id: str) -> ChatSession:
+    chat_session = SESSION_CACHE.get(session_id)
+    if chat_session is None:
+        # Fetch-or-create in one round trip; the session is then only mutated in memory
+        # and written once at the end of the turn.
+        chat_session = await ChatSession.find_one(ChatSession.session_id == session_id).update(
+            {"$setOnInsert": {
+                "messages": [],
+                "last_suggested_roadmap": None,
+                "roadmap_confirmed": False,
+                "rejected_roadmaps": []
+            }},
+            upsert=True,
+            response_type=UpdateResponse.NEW_DOCUMENT,
+            projection={"messages": {"$slice": -CONVERSATION_HISTORY_WINDOW}}
+        )
+        SESSION_CACHE[session_id] = chat_session
+    return chat_session
+
+async def prepare_chat_turn(chat_session: ChatSession, user_input: str):
+    """Updates the session state for an on-topic message and looks up the response cache.
+
+    Returns (cached_response, full_prompt, query_vec, context_hash); exactly one of
+    cached_response / full_prompt is set.
+    """
+    is_first_turn = (
+        not chat_session.messages
+        and not chat_session.last_suggested_roadmap
+        and not chat_session.rejected_roadmaps
+    )
+    if chat_session.last_suggested_roadmap:
+        if REJECTION_RE.search(user_input):
+            if chat_session.last_suggested_roadmap not in chat_session.rejected_roadmaps:
+                chat_session.rejected_roadmaps.append(chat_session.last_suggested_roadmap)
+            chat_session.last_suggested_roadmap = None
+        elif ACCEPTANCE_RE.search(user_input):
+            chat_session.roadmap_confirmed = True
+    # Encoding, cache search and generation are blocking; keep them off the event loop.
+    query_vec = await encoder_batcher.encode(user_input)
+    if is_first_turn:
+        context_hash = FIRST_TURN_CONTEXT_HASH
+    else:
+        context_hash = compute_context_hash(
+            chat_session.rejected_roadmaps, chat_session.last_suggested_roadmap, chat_session.messages
+        )
+    cached_response = await asyncio.to_thread(find_cached_response, query_vec, context_hash)
+    if cached_response is not None:
+        return cached_response, None, query_vec, context_hash
+
+    relevant_tracks = get_relevant_tracks_from_keywords(query_vec)
+    if is_first_turn:
+        context = build_context("None", relevant_tracks)
+        full_prompt = f"{FIRST_TURN_PROMPT_PREFIX}{context}\n\nConversation History:\n\n\nUser: {user_input}\n\nAssistant:"
+    else:
+        relevant_tracks = [track for track in relevant_tracks if track not in chat_session.rejected_roadmaps]
+        rejected_key = ", ".join(sorted(chat_session.rejected_roadmaps)) or "None"
+        context = build_context(rejected_key, relevant_tracks)
+        conversation_history = [f"{msg.role}: {msg.content}" for msg in chat_session.messages[-CONVERSATION_HISTORY_WINDOW:]]
+        system_prompt = render_system_prompt(rejected_key)
+        full_prompt = f"{system_prompt}\n\nContext: {context}\n\nConversation History:\n" + "\n".join(conversation_history) + f"\n\nUser: {user_input}\n\nAssistant:"
+    return None, full_prompt, query_vec, context_hash
+
+async def resolve_official_track(suggested_track: str) -> Optional[str]:
+    suggested_track_vec = await encoder_batcher.encode(suggested_track)
+    return find_closest_official_track(suggested_track_vec, TRACK_NAME_MATCH_THRESHOLD)
+
+async def save_chat_turn(chat_session: ChatSession, user_input: str, assistant_response_message: str):
+    user_message = ChatMessage(role="user", content=user_input)
+    assistant_message = ChatMessage(role="assistant", content=assistant_response_message)
+    chat_session.messages = (chat_session.messages + [user_message, assistant_message])[-MAX_STORED_MESSAGES:]
+    # Append in place instead of rewriting the whole document; $slice keeps the array capped.
+    await ChatSession.find_one(ChatSession.id == chat_session.id).update({
+        "$push": {"messages": {
+            "$each": [user_message.model_dump(), assistant_message.model_dump()],
+            "$slice": -MAX_STORED_MESSAGES
+        }},
+        "$set": {
+            "last_suggested_roadmap": chat_session.last_suggested_roadmap,
+            "roadmap_confirmed": chat_session.roadmap_confirmed,
+            "rejected_roadmaps": chat_session.rejected_roadmaps
+        }
+    })
+    SESSION_CACHE[chat_session.session_id] = chat_session
+
+def format_sse(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
 
 @app.post("/chat", response_model=ChatResponse)
 async def handle_chat(request: ChatRequest):
     session_id = request.session_id
     user_input = request.user_input
     try:
-        chat_session = await ChatSession.find_one(ChatSession.session_id == session_id)
-        if not chat_session:
-            chat_session = ChatSession(session_id=session_id)
-            await chat_session.create()
+        chat_session = await load_chat_session(session_id)
         if is_off_topic(user_input):
-            assistant_response_message = "I'm here to help you choose the best learning track. Unfortunately, I can't assist with this topic."
+            assistant_response_message = OFF_TOPIC_RESPONSE
         else:
-            user_input_lower = user_input.lower()
-            rejection_keywords = ["no", "not interested", "don't like", "something else", "different"]
-            acceptance_keywords = ["yes", "interested", "sounds good", "tell me more", "like it"]
-            if chat_session.last_suggested_roadmap:
-                if any(keyword in user_input_lower for keyword in rejection_keywords):
-                    if chat_session.last_suggested_roadmap not in chat_session.rejected_roadmaps:
-                        chat_session.rejected_roadmaps.append(chat_session.last_suggested_roadmap)
-                    chat_session.last_suggested_roadmap = None
-                    await chat_session.save()
-                elif any(keyword in user_input_lower for keyword in acceptance_keywords):
-                    chat_session.roadmap_confirmed = True
-                    await chat_session.save()
-            relevant_tracks = get_relevant_tracks_from_keywords(user_input)
-            relevant_tracks = [track for track in relevant_tracks if track not in chat_session.rejected_roadmaps]
-            context = f"""
-            Experience Level: Not specified
-            Technical Interests: Not specified
-            Personal Goals: Not specified
-            Rejected Roadmaps: {', '.join(chat_session.rejected_roadmaps) if chat_session.rejected_roadmaps else 'None'}
-            Relevant Tracks Found: {', '.join(relevant_tracks) if relevant_tracks else 'None'}
-            """
-            conversation_history = [f"{msg.role}: {msg.content}" for msg in chat_session.messages[-10:]]
-            system_prompt = SYSTEM_PROMPT_TEMPLATE.format(
-                experience_level="Not specified",
-                technical_interests="Not specified",
-                personal_goals="Not specified",
-                rejected_tracks=", ".join(chat_session.rejected_roadmaps) if chat_session.rejected_roadmaps else "None"
-            )
-            full_prompt = f"{system_prompt}\n\nContext: {context}\n\nConversation History:\n" + "\n".join(conversation_history) + f"\n\nUser: {user_input}\n\nAssistant:"
-            response = gemini_model.generate_content(full_prompt)
-            assistant_response_message = response.text
+            cached_response, full_prompt, query_vec, context_hash = await prepare_chat_turn(chat_session, user_input)
+            if cached_response is not None:
+                assistant_response_message = cached_response
+            else:
+                response = await gemini_model.generate_content_async(full_prompt)
+                assistant_response_message = response.text
+                await store_cached_response(query_vec, assistant_response_message, context_hash)
             suggested_track = extract_suggested_track(assistant_response_message)
             if suggested_track:
-                official_track = find_closest_official_track(suggested_track, TRACK_NAME_MATCH_THRESHOLD)
+                official_track = await resolve_official_track(suggested_track)
                 if official_track:
                     chat_session.last_suggested_roadmap = official_track
-                    await chat_session.save()
-        chat_session.messages.append(ChatMessage(role="user", content=user_input))
-        chat_session.messages.append(ChatMessage(role="assistant", content=assistant_response_message))
-        await chat_session.save()
+        await save_chat_turn(chat_session, user_input, assistant_response_message)
         return ChatResponse(assistant_message=assistant_response_message, session_id=session_id)
     except Exception as e:
+        # The cached copy may hold unsaved mutations from this turn; reload it next time.
+        SESSION_CACHE.pop(session_id, None)
         print(f"Error in chat handler: {e}", file=sys.stderr)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/chat/stream")
+async def handle_chat_stream(request: ChatRequest):
+    """Server-sent events variant of /chat: `delta` events while generating, then a final `done` event."""
+    session_id = request.session_id
+    user_input = request.user_input
+    off_topic = is_off_topic(user_input)
+    try:
+        chat_session = await load_chat_session(session_id)
+        if off_topic:
+            cached_response, full_prompt, query_vec, context_hash = OFF_TOPIC_RESPONSE, None, None, None
+        else:
+            cached_response, full_prompt, query_vec, context_hash = await prepare_chat_turn(chat_session, user_input)
+    except Exception as e:
+        SESSION_CACHE.pop(session_id, None)
+        print(f"Error in chat stream handler: {e}", file=sys.stderr)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    async def event_stream():
+        accumulated = ""
+        # Matches cannot span a newline, so an unfinished bold span can only be on the last line.
+        scan_pos = 0
+        early_track: Optional[str] = None
+        early_task: Optional[asyncio.Task] = None
+        bold_seen = off_topic
+        turn_saved = False
+        try:
+            if cached_response is not None:
+                accumulated = cached_response
+                yield format_sse({"delta": cached_response})
+            else:
+                response = await gemini_model.generate_content_async(full_prompt, stream=True)
+                async for chunk in response:
+                    # chunk.text raises on part-less chunks (e.g. a final finish_reason-only chunk).
+                    if not chunk.parts:
+                        continue
+                    text = chunk.text
+                    if not text:
+                        continue
+                    accumulated += text
+                    yield format_sse({"delta": text})
+                    if not bold_seen:
+                        # Resolve the first bolded track while the rest of the reply is still decoding.
+                        match = SUGGESTED_BOLD_RE.search(accumulated, scan_pos)
+                        last_newline = accumulated.rfind("\n", scan_pos)
+                        if last_newline >= 0:
+                            scan_pos = last_newline + 1
+                        if match:
+                            bold_seen = True
+                            early_track = extract_suggested_track(match.group(0))
+                            if early_track:
+                                early_task = asyncio.create_task(resolve_official_track(early_track))
+            assistant_response_message = accumulated
+            if cached_response is None:
+                await store_cached_response(query_vec, assistant_response_message, context_hash)
+            if not off_topic:
+                # The full-text extraction is authoritative; the early lookup is only reused if it agrees.
+                suggested_track = extract_suggested_track(assistant_response_message)
+                official_track = None
+                if suggested_track and early_task is not None and suggested_track == early_track:
+                    official_track = await early_task
+                elif suggested_track:
+                    official_track = await resolve_official_track(suggested_track)
+                if official_track:
+                    chat_session.last_suggested_roadmap = official_track
+            await save_chat_turn(chat_session, user_input, assistant_response_message)
+            turn_saved = True
+            yield format_sse({"done": True, "session_id": session_id, "assistant_message": assistant_response_message})
+        except Exception as e:
+            print(f"Error in chat stream handler: {e}", file=sys.stderr)
+            yield format_sse({"error": "Internal server error"})
+        finally:
+            # Also reached when the client disconnects mid-stream.
+            if not turn_saved:
+                SESSION_CACHE.pop(session_id, None)
+            if early_task is not None:
+                if not early_task.done():
+                    early_task.cancel()
+                elif not early_task.cancelled():
+                    # Retrieve a discarded failure so asyncio does not log it as never retrieved.
+                    early_task.exception()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "chatbot"}